@@ -1,4 +1,3 @@
-import json
 import random
 import os
 import aiohttp
@@ -6,6 +5,8 @@ import asyncio
 from pathlib import Path
 from astrbot.api import logger
 
+from .json_compat import dumps as json_dumps, load_file
+
 
 class ComfyUI:
     def __init__(self, config: dict, data_dir: Path = None) -> None:
@@ -74,8 +75,7 @@ class ComfyUI:
     def _load_workflow(self):
         if not self.workflow_path.exists():
             raise FileNotFoundError(f"工作流文件不存在: {self.workflow_path}")
-        with open(self.workflow_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return load_file(self.workflow_path)
 
     def _inject_params(self, workflow, prompt):
         """参数注入：写提示词 + 覆盖步数 + 强制改所有 seed/noise_seed"""
@@ -166,8 +166,7 @@ class ComfyUI:
             if not sidecar.exists():
                 return {}
         
-            with open(sidecar, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            data = load_file(sidecar)
         
             if not isinstance(data, dict):
                 return {}
@@ -264,7 +263,7 @@ class ComfyUI:
         payload = {"prompt": workflow, "client_id": client_id}
         logger.info(f"[ComfyUI] ===== 发送给服务器的完整 payload =====")
         logger.info(f"[ComfyUI] client_id: {client_id}")
-        logger.info(f"[ComfyUI] prompt: {json.dumps(payload, indent=2, ensure_ascii=False)}")
+        logger.info(f"[ComfyUI] prompt: {json_dumps(payload).decode('utf-8')}")
         logger.info(f"[ComfyUI] ====================================")
 
         async with aiohttp.ClientSession() as session:
@@ -276,7 +275,7 @@ class ComfyUI:
                         return None, f"连接 ComfyUI 失败: {resp.status}"
                     res_json = await resp.json()
                     prompt_id = res_json.get("prompt_id")
-                    logger.info(f"[ComfyUI] 服务器响应: {json.dumps(res_json, ensure_ascii=False)}")
+                    logger.info(f"[ComfyUI] 服务器响应: {json_dumps(res_json, indent=False).decode('utf-8')}")
             except Exception as e:
                 logger.error(f"[ComfyUI] 请求异常: {e}")
                 return None, f"请求报错: {str(e)}"
@@ -290,7 +289,7 @@ class ComfyUI:
                         if h_resp.status != 200:
                             continue
                         history = await h_resp.json()
-                        # logger.debug(f"[ComfyUI] history响应: {json.dumps(history, ensure_ascii=False)}")
+                        # logger.debug(f"[ComfyUI] history响应: {json_dumps(history, indent=False).decode('utf-8')}")
                 except:
                     continue
 
@@ -0,0 +1,41 @@
+import json
+from pathlib import Path
+
+# 尝试导入 orjson（可选，比标准库 json 快数倍），不可用时回退到标准库
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，统一捕获这一个即可
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data):
+    """解析 JSON，接受 str 或 UTF-8 bytes"""
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent: bool = True) -> bytes:
+    """序列化为保留中文的 UTF-8 bytes，默认缩进 2 格；indent=False 时输出单行"""
+    if HAS_ORJSON:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode("utf-8")
+
+
+def load_file(path: Path):
+    """读取并解析 JSON 文件"""
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def dump_file(path: Path, obj) -> None:
+    """将对象写入 JSON 文件"""
+    with open(path, "wb") as f:
+        f.write(dumps(obj))
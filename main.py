@@ -1,10 +1,13 @@
 import os
-import uuid
+import sys
+import asyncio
+import inspect
 import time
+import random
 import re
 import traceback
-import json
 import shutil
+import string
 from pathlib import Path
 from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
 from astrbot.api.star import Context, Star, register
@@ -12,6 +15,8 @@ from astrbot.api.message_components import *
 from astrbot.api import llm_tool, logger
 from astrbot.api.provider import LLMResponse
 
+from .json_compat import JSONDecodeError, dump_file, dumps as json_dumps, load_file, loads as json_loads
+
 # 尝试导入 StarTools（兼容不同版本）
 try:
     from astrbot.api.star import StarTools
@@ -20,9 +25,93 @@ except ImportError:
     HAS_STAR_TOOLS = False
     logger.warning("[ComfyUI] 无法导入 StarTools，将使用备用目录方案")
 
+# 预先探测 StarTools.get_data_dir 的签名：参数均有默认值时无参调用，否则传入插件实例
+_DATA_DIR_NO_ARGS = True
+if HAS_STAR_TOOLS:
+    try:
+        _DATA_DIR_NO_ARGS = all(
+            p.default is not inspect.Parameter.empty
+            or p.kind in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD)
+            for p in inspect.signature(StarTools.get_data_dir).parameters.values()
+        )
+    except (TypeError, ValueError):
+        pass
+
+# 尝试导入 pyahocorasick（可选，用于加速敏感词匹配）
+try:
+    import ahocorasick
+    HAS_AHOCORASICK = True
+except ImportError:
+    HAS_AHOCORASICK = False
+
+# 尝试导入 google-re2（可选，线性时间正则引擎，用于无自动机时的回退匹配）
+try:
+    import re2
+    HAS_RE2 = True
+except ImportError:
+    HAS_RE2 = False
+
+# 尝试导入 ijson（可选，用于流式解析敏感词库）
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+# 尝试导入 aiofiles（可选，保存图片时不阻塞事件循环）
+try:
+    import aiofiles
+    HAS_AIOFILES = True
+except ImportError:
+    HAS_AIOFILES = False
+
 # 获取插件目录（用于读取默认文件）
 PLUGIN_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 
+# 英文单词边界字符（与正则中的 [A-Za-z0-9_] 一致）
+_WORD_CHARS = frozenset(string.ascii_letters + string.digits + "_")
+
+# LLM 偶尔残留在提示词开头的前缀
+_PROMPT_PREFIX = "提示词是"
+
+# 提示词首尾需去除的引号（含中文引号）
+_STRIP_CHARS = '`"\'\u201c\u201d\u2018\u2019'
+
+# 预编译的正则（避免在请求热路径中重复编译）
+_MATH_AT_RE = re.compile(r'```math\s*At:\d+```\s*')
+_HAS_WORD_CHAR = re.compile(r'[A-Za-z0-9_]').search
+_PROMPT_RE = re.compile(r'<提示词>(.*?)</提示词>', re.DOTALL)
+
+
+def _char_class(chars) -> str:
+    """把若干单个字符拼成正则字符类，只有一个字符时直接转义"""
+    if len(chars) == 1:
+        return re.escape(chars[0])
+    return '[' + ''.join(re.escape(c) for c in chars) + ']'
+
+
+def _alternation(rests: list) -> str:
+    """拼接同一首字符下各词条的剩余部分：单字符分支合并为字符类，空分支（词条只有首字符）放在最后"""
+    alts = [re.escape(r) for r in rests if len(r) > 1]
+    singles = [r for r in rests if len(r) == 1]
+    if singles:
+        alts.append(_char_class(singles))
+    if '' in rests:
+        alts.append('')
+    return '|'.join(alts)
+
+
+def _chain_has_image(chain) -> bool:
+    """判断消息链（含合并转发节点内的内容）中是否已有图片，用栈迭代代替递归"""
+    stack = list(chain)
+    while stack:
+        comp = stack.pop()
+        if isinstance(comp, Image):
+            return True
+        if isinstance(comp, Node):
+            stack.extend(comp.content)
+    return False
+
 
 @register(
     "astrbot_plugin_comfyui_pro",  
@@ -47,26 +136,35 @@ class ComfyUIPlugin(Star):
         self.workflow_dir = self.data_dir / "workflow"
         self.output_dir = self.data_dir / "output"
         self.sensitive_words_path = self.data_dir / "sensitive_words.json"
+        # 当前工作流的步数覆盖文件，切换工作流时更新（与 ComfyUI API 读取同一配置项）
+        wf_conf = config.get("workflow_settings", {})
+        self._set_current_sidecar(wf_conf.get("json_file", "workflow_api.json"))
+        self.persist_images = bool(wf_conf.get("persist_images", True))
         
         # ====== 4. 更新 UI 配置 ======
+        self._wf_list_cache = None  # (目录 mtime_ns, 文件名元组)
+        self._schema_cache = None   # (schema 文件 mtime_ns, 解析后的 dict)
         self._auto_update_schema()
         
         # Control 配置
         control_conf = config.get("control", {})
         self.cooldown_seconds = control_conf.get("cooldown_seconds", 60)
         self.user_cooldowns = {}
-        self.admin_user_ids = set(map(str, control_conf.get("admin_ids", [])))
+        self.admin_user_ids = frozenset(map(str, control_conf.get("admin_ids", [])))
         self.lockdown = bool(control_conf.get("lockdown", False))
-        self.whitelist_group_ids = set(map(str, control_conf.get("whitelist_group_ids", [])))
+        self.whitelist_group_ids = frozenset(map(str, control_conf.get("whitelist_group_ids", [])))
     
         llm_settings = config.get("llm_settings", {})
         self.multi_image_mode = llm_settings.get("multi_image_mode", False)
         logger.info(f"[ComfyUI] 🖼️ 多图模式: {'开启' if self.multi_image_mode else '关闭'}")
-        # 策略配置
-        self.default_group_policy = str(control_conf.get("default_group_policy", "none")).lower()
-        self.default_private_policy = str(control_conf.get("default_private_policy", "none")).lower()
+        # 多图模式下同时向 ComfyUI 提交的最大任务数
+        self.max_parallel = max(1, int(llm_settings.get("max_parallel", 2)))
+        self._generate_semaphore = asyncio.Semaphore(self.max_parallel)
+        # 策略配置（策略名驻留为与字典键相同的对象，查匹配器时走身份比较的快速路径）
+        self.default_group_policy = sys.intern(str(control_conf.get("default_group_policy", "none")).lower())
+        self.default_private_policy = sys.intern(str(control_conf.get("default_private_policy", "none")).lower())
         self.group_policies = {
-            str(k): str(v).lower()
+            str(k): sys.intern(str(v).lower())
             for k, v in control_conf.get("group_policies", {}).items()
         }
         self.policies = {
@@ -88,32 +186,56 @@ class ComfyUIPlugin(Star):
         if self.lockdown:
             logger.warning("[ComfyUI]⚠️ 全局锁定已启用，仅管理员可用")
 
-        # 加载敏感词
-        self.lexicon = {}
-        try:
-            if self.sensitive_words_path.exists():
-                with open(self.sensitive_words_path, "r", encoding="utf-8") as f:
-                    self.lexicon = json.load(f)
-                word_count = sum(len(v) for v in self.lexicon.values() if isinstance(v, list))
-                logger.info(f"[ComfyUI] 🔒 敏感词库已加载: {word_count} 个词条")
-            else:
-                self.lexicon = {"legacy_lite": [], "full": []} 
-        except Exception:
-            self.lexicon = {"legacy_lite": [], "full": []}
-
+        # 加载敏感词（边解析边归入各策略，不保留完整词库）；匹配器在首次用到某策略时才编译
         self._policy_patterns = {}
+        self._policy_automata = {}
         self._build_policy_patterns()
         
-        # 初始化 ComfyUI API
+        # /comfy帮助 的静态部分，只构建一次
+        help_user = [
+            "🎨 ComfyUI Pro 插件帮助",
+            "━━━━━━━━━━━━━━━━━━",
+            "",
+            "【基础指令】",
+            "  /draw <提示词>      生成图片（直发模式）",
+            "  /draw_no <提示词>   生成图片（转发模式）",
+            "  /comfy帮助         显示此帮助",
+            "",
+            "【LLM 模式】",
+            "  直接对话：'帮我画一个可爱的猫娘'",
+            ""
+        ]
+        help_admin = [
+            "【管理员指令】 👑",
+            "  /comfy_ls          列出所有工作流",
+            "  /comfy_use <序号>  切换工作流",
+            "  /comfy_save        导入新工作流",
+            "  /comfy_add         步数覆盖（按节点ID）",
+            "  /违禁级别          设置群敏感度",
+            ""
+        ]
+        separator = "━━━━━━━━━━━━━━━━━━"
+        self._help_prefix_user = "\n".join(help_user + [separator])
+        self._help_prefix_admin = "\n".join(help_user + help_admin + [separator])
+
+        # ComfyUI API 延迟到首次使用时再初始化（见 api 属性）
         self.comfy_ui = None
-        self.api = None
-        try:
-            from .comfyui_api import ComfyUI
-            self.api = ComfyUI(self.config, data_dir=self.data_dir)
-            logger.info(f"[ComfyUI] ✅ ComfyUI API 初始化成功")
-        except Exception as e:
-            logger.error(f"[ComfyUI] ❌ ComfyUI API 初始化失败: {e}")
-            logger.error(traceback.format_exc())
+        self._api = None
+        self._api_error = False  # 初始化失败后不再重试，避免每次访问都重复打印堆栈
+
+    @property
+    def api(self):
+        """ComfyUI API 客户端，首次访问时才导入并创建；失败时记录一次错误，之后直接返回 None"""
+        if self._api is None and not self._api_error:
+            try:
+                from .comfyui_api import ComfyUI
+                self._api = ComfyUI(self.config, data_dir=self.data_dir)
+                logger.info(f"[ComfyUI] ✅ ComfyUI API 初始化成功")
+            except Exception as e:
+                self._api_error = True
+                logger.error(f"[ComfyUI] ❌ ComfyUI API 初始化失败: {e}")
+                logger.error(traceback.format_exc())
+        return self._api
 
     # ====== 获取持久化目录 ======
     def _get_persistent_dir(self) -> Path:
@@ -121,16 +243,15 @@ class ComfyUIPlugin(Star):
         data_path = None
         
         if HAS_STAR_TOOLS:
+            # 按探测结果直接调用；失败时只再尝试另一种方式一次
+            args = () if _DATA_DIR_NO_ARGS else (self,)
             try:
-                data_path = StarTools.get_data_dir(self)
+                data_path = StarTools.get_data_dir(*args)
             except Exception:
                 try:
-                    data_path = StarTools.get_data_dir()
-                except Exception:
-                    try:
-                        data_path = StarTools.get_data_dir(self.context)
-                    except Exception:
-                        pass
+                    data_path = StarTools.get_data_dir(*(() if args else (self,)))
+                except Exception as e:
+                    logger.warning(f"[ComfyUI] StarTools.get_data_dir 调用失败: {e}")
         
         if data_path is None:
             current = Path.cwd()
@@ -155,14 +276,17 @@ class ComfyUIPlugin(Star):
         plugin_workflow_dir = PLUGIN_DIR / "workflow"
         copied_count = 0
         if plugin_workflow_dir.exists():
-            for src_file in plugin_workflow_dir.glob("*.json"):
-                dst_file = workflow_dir / src_file.name
-                if not dst_file.exists():
-                    try:
-                        shutil.copy2(src_file, dst_file)
-                        copied_count += 1
-                    except Exception as e:
-                        logger.error(f"[ComfyUI] 复制工作流失败 {src_file.name}: {e}")
+            with os.scandir(plugin_workflow_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith(".json") or not entry.is_file():
+                        continue
+                    dst_file = workflow_dir / entry.name
+                    if not dst_file.exists():
+                        try:
+                            shutil.copy2(entry.path, dst_file)
+                            copied_count += 1
+                        except Exception as e:
+                            logger.error(f"[ComfyUI] 复制工作流失败 {entry.name}: {e}")
         
         if copied_count > 0:
             logger.info(f"[ComfyUI] 📋 已复制 {copied_count} 个默认工作流")
@@ -187,45 +311,82 @@ class ComfyUIPlugin(Star):
             if not workflow_dir.exists():
                 return
 
-            # 排除 .steps.json 文件
-            files = sorted([
-                f.name for f in workflow_dir.glob("*.json")
-                if not f.name.endswith(".steps.json")
-            ])
+            files = list(self._list_workflows())
         
             if not files:
                 files = ["workflow_api.json"]
 
-            with open(schema_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            # 文件未被外部修改时复用已解析的 schema
+            mtime_ns = schema_path.stat().st_mtime_ns
+            cached = self._schema_cache
+            if cached is not None and cached[0] == mtime_ns:
+                data = cached[1]
+            else:
+                data = load_file(schema_path)
 
             target = data['workflow_settings']['items']['json_file']
-            target['options'] = files
-            target['enum'] = files
-        
-            with open(schema_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-        
+            if target.get('options') != files or target.get('enum') != files:
+                target['options'] = files
+                target['enum'] = files
+            
+                dump_file(schema_path, data)
+                mtime_ns = schema_path.stat().st_mtime_ns
+
+            self._schema_cache = (mtime_ns, data)
             logger.info(f"[ComfyUI] 🔄 工作流列表已更新: {len(files)} 个可用")
 
         except Exception as e:
             logger.error(f"[ComfyUI] 更新工作流列表失败: {e}")
 
+    def _list_workflows(self) -> tuple:
+        """列出工作流文件名（排除 .steps.json）"""
+        return self._scan_workflow_dir()[0]
+
+    def _scan_workflow_dir(self) -> tuple:
+        """
+        单次扫描工作流目录，返回 (工作流文件名元组, 步数覆盖文件名集合)
+        目录 mtime 未变时直接返回缓存
+        """
+        workflow_dir = self.data_dir / "workflow"
+        mtime_ns = workflow_dir.stat().st_mtime_ns
+        cached = self._wf_list_cache
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+        files = []
+        sidecars = set()
+        with os.scandir(workflow_dir) as it:
+            for e in it:
+                name = e.name
+                if name.endswith(".steps.json"):
+                    sidecars.add(name)
+                elif name.endswith(".json") and e.is_file():
+                    files.append(name)
+        result = (tuple(sorted(files)), frozenset(sidecars))
+        self._wf_list_cache = (mtime_ns, result)
+        return result
+
+    def _set_current_sidecar(self, filename: str):
+        """根据工作流文件名计算并缓存其 .steps.json 路径"""
+        self._current_sidecar_path = self.workflow_dir / f"{Path(filename).stem}.steps.json"
+
     # ====== 权限检查（返回原因）======
-    def _check_access(self, event: AstrMessageEvent) -> tuple:
+    def _check_access(self, event: AstrMessageEvent, user_id: str = None, is_admin: bool = None) -> tuple:
         """
         统一的权限检查，返回 (是否通过, 拒绝原因)
         """
-        user_id = str(event.get_sender_id())
-        is_admin = user_id in self.admin_user_ids
+        if user_id is None:
+            user_id = str(event.get_sender_id())
+        if is_admin is None:
+            is_admin = user_id in self.admin_user_ids
         
         # 1. 全局锁定检查
         if self.lockdown and not is_admin:
             return False, "🔒 全局锁定中，仅管理员可用"
         
         # 2. 群聊白名单检查
-        if self._is_group_message(event):
-            gid = self._get_group_id(event)
+        is_group, gid = self._resolve_scope(event)
+        if is_group:
             if not gid:
                 return False, "⚠️ 无法获取群号"
             
@@ -239,18 +400,28 @@ class ComfyUIPlugin(Star):
         
         return True, ""
 
-    def _check_cooldown(self, event: AstrMessageEvent) -> tuple:
+    def _check_cooldown(self, event: AstrMessageEvent, user_id: str = None, is_admin: bool = None) -> tuple:
         """
         冷却检查，返回 (是否通过, 剩余秒数或0)
         """
-        user_id = str(event.get_sender_id())
-        is_admin = user_id in self.admin_user_ids
+        if user_id is None:
+            user_id = str(event.get_sender_id())
+        if is_admin is None:
+            is_admin = user_id in self.admin_user_ids
         
         # 管理员绕过冷却
         if is_admin and self.admin_bypass_cooldown:
             return True, 0
         
         current_time = time.time()
+
+        # 约每 100 次调用压缩一次，丢弃早已过期的记录，避免字典无限增长
+        if random.random() < 0.01:
+            cutoff = current_time - 2 * self.cooldown_seconds
+            self.user_cooldowns = {
+                k: v for k, v in self.user_cooldowns.items() if v > cutoff
+            }
+
         last_time = self.user_cooldowns.get(user_id, 0)
         elapsed = current_time - last_time
 
@@ -261,25 +432,47 @@ class ComfyUIPlugin(Star):
         self.user_cooldowns[user_id] = current_time
         return True, 0
 
-    def _check_sensitive(self, prompt: str, event: AstrMessageEvent) -> tuple:
+    def _check_sensitive(self, prompt: str, event: AstrMessageEvent, user_id: str = None, is_admin: bool = None) -> tuple:
         """
         敏感词检查，返回 (是否通过, 触发的敏感词列表)
         """
-        user_id = str(event.get_sender_id())
-        is_admin = user_id in self.admin_user_ids
+        if user_id is None:
+            user_id = str(event.get_sender_id())
+        if is_admin is None:
+            is_admin = user_id in self.admin_user_ids
+        
+        # 管理员绕过：只需判断是否命中，找到第一个即停止扫描
+        if is_admin and self.admin_bypass_sensitive:
+            hit = self._find_sensitive_words(prompt, event, first_only=True)
+            if hit:
+                logger.info(f"[ComfyUI] 👑 管理员 {user_id} 使用敏感词 {hit}，已放行")
+            return True, []
         
         sensitive = self._find_sensitive_words(prompt, event)
         
         if not sensitive:
             return True, []
         
-        # 管理员绕过
-        if is_admin and self.admin_bypass_sensitive:
-            logger.info(f"[ComfyUI] 👑 管理员 {user_id} 使用敏感词 {sensitive}，已放行")
-            return True, []
-        
         return False, sensitive
 
+    def _gate(self, event: AstrMessageEvent, prompt: str, user_id: str, is_admin: bool) -> tuple:
+        """
+        生成前的敏感词 → 冷却检查，返回 (是否通过, 拒绝原因)
+        权限检查由调用方在最前面完成，发送者 ID 与管理员身份由调用方算好传入、各项检查共用
+        """
+        passed, sensitive = self._check_sensitive(prompt, event, user_id, is_admin)
+        if not passed:
+            tip = "、".join(sensitive[:5])  # 最多显示5个
+            extra = f"等 {len(sensitive)} 个" if len(sensitive) > 5 else ""
+            logger.warning(f"[ComfyUI] 用户 {user_id} 触发敏感词: {tip}")
+            return False, f"🚫 检测到敏感词：{tip}{extra}，无法生成图片"
+
+        ok, remain = self._check_cooldown(event, user_id, is_admin)
+        if not ok:
+            return False, f"⏱️ 冷却中，请在 {remain} 秒后重试"
+
+        return True, ""
+
     @filter.on_llm_request()
     async def inject_system_prompt(self, event: AstrMessageEvent, req):
         """注入系统提示词"""
@@ -310,15 +503,17 @@ class ComfyUIPlugin(Star):
     # ====== 核心绘图逻辑 ======
     async def _handle_paint_logic(self, event: AstrMessageEvent, direct_send: bool):
         """处理 draw/draw_no 的核心逻辑"""
-        # 权限检查
-        allowed, reason = self._check_access(event)
+        # 权限检查（只在这里做一次，后续生成直接复用 user_id / is_admin）
+        user_id = str(event.get_sender_id())
+        is_admin = user_id in self.admin_user_ids
+        allowed, reason = self._check_access(event, user_id, is_admin)
         if not allowed:
             yield event.plain_result(reason)
             return
 
         try:
-            full_message = event.message_str.strip()
-            parts = full_message.split(' ', 1)
+            # 一次切分出指令与提示词（split(None) 会同时跳过多余空白和换行）
+            parts = event.message_str.split(None, 1)
             prompt = parts[1].strip() if len(parts) > 1 else ""
 
             # 如果没有提供 prompt，获取最新 LLM 响应并润色
@@ -350,7 +545,7 @@ class ComfyUIPlugin(Star):
                             if not history_str:
                                 return None
                             try:
-                                data = json.loads(history_str) if isinstance(history_str, str) else history_str
+                                data = json_loads(history_str) if isinstance(history_str, str) else history_str
                                 messages = data if isinstance(data, list) else data.get("messages", [])
                                 for msg in reversed(messages):
                                     if msg.get("role") == "assistant":
@@ -419,16 +614,8 @@ class ComfyUIPlugin(Star):
                     yield event.plain_result(f"❌ 获取提示词失败，请直接输入提示词")
                     return
 
-            # 敏感词检查
-            passed, sensitive = self._check_sensitive(prompt, event)
-            if not passed:
-                tip = "、".join(sensitive[:5])  # 最多显示5个
-                extra = f"等 {len(sensitive)} 个" if len(sensitive) > 5 else ""
-                yield event.plain_result(f"🚫 检测到敏感词：{tip}{extra}，无法生成图片")
-                return
-
-            # 调用工具生成图片
-            result = await self.comfyui_txt2img(event, prompt=prompt)
+            # 权限已检查过，直接走生成流程（敏感词、冷却检查在其中统一进行）
+            result = await self._txt2img(event, prompt, user_id, is_admin)
             if result:
                 yield result
 
@@ -449,41 +636,19 @@ class ComfyUIPlugin(Star):
         user_id = str(event.get_sender_id())
         is_admin = user_id in self.admin_user_ids
         
-        tips = [
-            "🎨 ComfyUI Pro 插件帮助",
-            "━━━━━━━━━━━━━━━━━━",
-            "",
-            "【基础指令】",
-            "  /draw <提示词>      生成图片（直发模式）",
-            "  /draw_no <提示词>   生成图片（转发模式）",
-            "  /comfy帮助         显示此帮助",
-            "",
-            "【LLM 模式】",
-            "  直接对话：'帮我画一个可爱的猫娘'",
-            ""
-        ]
-        
-        if is_admin:
-            tips.extend([
-                "【管理员指令】 👑",
-                "  /comfy_ls          列出所有工作流",
-                "  /comfy_use <序号>  切换工作流",
-                "  /comfy_save        导入新工作流",
-                "  /comfy_add         步数覆盖（按节点ID）",
-                "  /违禁级别          设置群敏感度",
-                ""
-            ])
+        prefix = self._help_prefix_admin if is_admin else self._help_prefix_user
         
         # 状态信息
-        tips.append("━━━━━━━━━━━━━━━━━━")
-        tips.append(f"📍 当前位置：{'群聊 ' + gid if gid else '私聊'}")
-        tips.append(f"🔒 违禁级别：{policy}")
-        tips.append(f"⏱️ 冷却时间：{self.cooldown_seconds} 秒")
+        text = (
+            f"{prefix}\n"
+            f"📍 当前位置：{'群聊 ' + gid if gid else '私聊'}\n"
+            f"🔒 违禁级别：{policy}\n"
+            f"⏱️ 冷却时间：{self.cooldown_seconds} 秒"
+        )
         if is_admin:
-            tips.append(f"👑 身份：管理员")
-            tips.append(f"📂 数据目录：{self.data_dir}")
+            text += f"\n👑 身份：管理员\n📂 数据目录：{self.data_dir}"
         
-        yield event.plain_result("\n".join(tips))
+        yield event.plain_result(text)
     @filter.command("comfy_test_send2")
     async def cmd_test_send2(self, event: AstrMessageEvent):
         """测试主动发送 - 第二轮"""
@@ -578,8 +743,7 @@ class ComfyUIPlugin(Star):
             yield event.plain_result("🚫 权限不足，仅管理员可修改违禁级别")
             return
 
-        full_msg = event.message_str.strip()
-        parts = full_msg.split()
+        parts = event.message_str.split(None, 2)
         gid = self._get_group_id(event) or "未知"
 
         if len(parts) == 1:
@@ -596,7 +760,7 @@ class ComfyUIPlugin(Star):
             )
             return
 
-        level = parts[1].lower()
+        level = sys.intern(parts[1].lower())
         if level not in self.policies:
             yield event.plain_result("❌ 无效级别，可选：none / lite / full")
             return
@@ -617,33 +781,28 @@ class ComfyUIPlugin(Star):
             yield event.plain_result("❌ 工作流目录不存在")
             return
 
-        # 排除 .steps.json 文件
-        files = sorted([
-            f.name for f in self.workflow_dir.glob("*.json") 
-            if not f.name.endswith(".steps.json")
-        ])
+        files, sidecars = self._scan_workflow_dir()
     
         if not files:
             yield event.plain_result("📂 目录中没有工作流文件")
             return
 
-        current_file = self.api.wf_filename if self.api else "未知"
+        api = self.api
+        current_file = api.wf_filename if api else "未知"
     
         msg = ["📂 可用工作流列表", "━━━━━━━━━━━━━━━━━━"]
     
         for i, f in enumerate(files, 1):
-            stem = Path(f).stem
-            sidecar = self.workflow_dir / f"{stem}.steps.json"
+            sidecar_name = f"{f[:-5]}.steps.json"  # 去掉 ".json"
         
             # 检查是否有步数覆盖（新格式：按节点ID存储）
             steps_info = ""
-            if sidecar.exists():
+            if sidecar_name in sidecars:
                 try:
-                    with open(sidecar, "r", encoding="utf-8") as sf:
-                        data = json.load(sf)
-                        if data and isinstance(data, dict):
-                            count = len(data)
-                            steps_info = f" [覆盖:{count}项]"
+                    data = load_file(self.workflow_dir / sidecar_name)
+                    if data and isinstance(data, dict):
+                        count = len(data)
+                        steps_info = f" [覆盖:{count}项]"
                 except:
                     pass
         
@@ -668,7 +827,7 @@ class ComfyUIPlugin(Star):
             yield event.plain_result("🚫 权限不足，仅管理员可切换工作流")
             return
 
-        args = event.message_str.split()
+        args = event.message_str.split(None, 5)
         if len(args) < 2:
             yield event.plain_result(
                 "❌ 参数不足\n"
@@ -678,11 +837,7 @@ class ComfyUIPlugin(Star):
             return
 
         try:
-            # 排除 .steps.json 文件
-            files = sorted([
-                f.name for f in self.workflow_dir.glob("*.json")
-                if not f.name.endswith(".steps.json")
-            ])
+            files = self._list_workflows()
         
             index = int(args[1])
             if not (1 <= index <= len(files)):
@@ -700,17 +855,19 @@ class ComfyUIPlugin(Star):
         neg_id = args[3] if len(args) > 3 else None
         out_id = args[4] if len(args) > 4 else None
 
-        if not self.api:
+        api = self.api
+        if not api:
             yield event.plain_result("❌ ComfyUI API 未初始化")
             return
 
-        exists, msg = self.api.reload_config(
+        exists, msg = api.reload_config(
             filename, 
             input_id=inp_id, 
             neg_node_id=neg_id,
             output_id=out_id
         )
         
+        self._set_current_sidecar(filename)
         status = "✅" if exists else "⚠️"
         logger.info(f"[ComfyUI] 管理员 {user_id} 切换工作流: {filename}")
         yield event.plain_result(f"{status} {msg}")
@@ -742,17 +899,28 @@ class ComfyUIPlugin(Star):
 
         try:
             json_str = json_str.replace("```json", "").replace("```", "").strip()
-            json_data = json.loads(json_str)
-        except json.JSONDecodeError as e:
+            json_data = json_loads(json_str)
+        except JSONDecodeError as e:
             yield event.plain_result(f"❌ JSON 解析失败：{str(e)[:50]}")
             return
 
         save_path = self.workflow_dir / filename
 
+        # 先写临时文件再替换，写入中途失败不会损坏已有的同名工作流
+        tmp_path = save_path.with_name(save_path.name + ".tmp")
         try:
-            with open(save_path, 'w', encoding='utf-8') as f:
-                json.dump(json_data, f, indent=2, ensure_ascii=False)
+            # 先序列化再打开文件，序列化失败时不会留下空的临时文件
+            data = json_dumps(json_data)
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, save_path)
+            except Exception:
+                tmp_path.unlink(missing_ok=True)
+                raise
             
+            # 目录 mtime 精度可能不足以区分紧邻的两次写入，主动失效
+            self._wf_list_cache = None
             self._auto_update_schema()
             
             logger.info(f"[ComfyUI] 管理员 {user_id} 导入工作流: {filename}")
@@ -824,15 +992,13 @@ class ComfyUIPlugin(Star):
     
         # 获取当前工作流的 sidecar 路径
         current_file = self.api.wf_filename
-        stem = Path(current_file).stem
-        sidecar_path = self.workflow_dir / f"{stem}.steps.json"
+        sidecar_path = self._current_sidecar_path
     
         # 读取现有配置
         existing = {}
         if sidecar_path.exists():
             try:
-                with open(sidecar_path, "r", encoding="utf-8") as f:
-                    existing = json.load(f)
+                existing = load_file(sidecar_path)
             except:
                 existing = {}
     
@@ -865,12 +1031,12 @@ class ComfyUIPlugin(Star):
         # 保存
         try:
             if existing:
-                with open(sidecar_path, "w", encoding="utf-8") as f:
-                    json.dump(existing, f, ensure_ascii=False, indent=2)
+                dump_file(sidecar_path, existing)
             else:
                 # 如果清空了，删除文件
                 if sidecar_path.exists():
                     sidecar_path.unlink()
+            self._wf_list_cache = None
         
             # 构建反馈消息
             msg_parts = []
@@ -891,8 +1057,7 @@ class ComfyUIPlugin(Star):
         """列出当前工作流的步数覆盖"""
     
         current_file = self.api.wf_filename
-        stem = Path(current_file).stem
-        sidecar_path = self.workflow_dir / f"{stem}.steps.json"
+        sidecar_path = self._current_sidecar_path
     
         lines = [
             f"📊 当前工作流步数覆盖",
@@ -905,8 +1070,7 @@ class ComfyUIPlugin(Star):
             lines.append("ℹ️ 暂无步数覆盖配置")
         else:
             try:
-                with open(sidecar_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
+                data = load_file(sidecar_path)
             
                 if not data:
                     lines.append("ℹ️ 暂无步数覆盖配置")
@@ -931,8 +1095,7 @@ class ComfyUIPlugin(Star):
         """清空当前工作流的所有步数覆盖"""
     
         current_file = self.api.wf_filename
-        stem = Path(current_file).stem
-        sidecar_path = self.workflow_dir / f"{stem}.steps.json"
+        sidecar_path = self._current_sidecar_path
     
         if not sidecar_path.exists():
             yield event.plain_result(f"ℹ️ {current_file} 本来就没有步数覆盖")
@@ -940,6 +1103,7 @@ class ComfyUIPlugin(Star):
     
         try:
             sidecar_path.unlink()
+            self._wf_list_cache = None
             user_id = str(event.get_sender_id())
             logger.info(f"[ComfyUI] 管理员 {user_id} 清空步数覆盖: {current_file}")
             yield event.plain_result(f"✅ 已清空 {current_file} 的所有步数覆盖")
@@ -958,112 +1122,326 @@ class ComfyUIPlugin(Star):
 
     # ====== 辅助方法 ======
     def _is_group_message(self, event: AstrMessageEvent) -> bool:
-        mt = getattr(event, "message_type", None)
-        if mt is not None:
-            return mt == "group"
-        try:
-            if hasattr(event, "get_group_id"):
-                gid = event.get_group_id()
-                if gid:
-                    return True
-            gid_attr = getattr(event, "group_id", None)
-            return gid_attr is not None
-        except Exception:
-            return False
+        return self._resolve_scope(event)[0]
 
     def _get_group_id(self, event: AstrMessageEvent):
-        if not self._is_group_message(event):
-            return None
-        getters = [
-            lambda e: e.get_group_id() if hasattr(e, "get_group_id") else None,
-            lambda e: getattr(e, "group_id", None),
-            lambda e: getattr(getattr(e, "scene", None), "group_id", None),
-        ]
-        for g in getters:
+        return self._resolve_scope(event)[1]
+
+    def _resolve_scope(self, event: AstrMessageEvent) -> tuple:
+        """一次解析事件的 (是否群聊, 群号)；同一事件会被多次查询（多图模式下每张图一次），结果缓存在事件上"""
+        scope = getattr(event, "_comfy_scope", None)
+        if scope is not None:
+            return scope
+
+        gid = None
+        get_group_id = getattr(event, "get_group_id", None)
+        if get_group_id is not None:
             try:
-                gid = g(event)
-                if gid:
-                    return str(gid)
+                gid = get_group_id()
             except Exception:
-                continue
-        return None
+                gid = None
+
+        mt = getattr(event, "message_type", None)
+        if mt is not None:
+            is_group = mt == "group"
+        else:
+            is_group = bool(gid) or getattr(event, "group_id", None) is not None
+
+        if not is_group:
+            scope = (False, None)
+        else:
+            if not gid:
+                gid = getattr(event, "group_id", None)
+            if not gid:
+                gid = getattr(getattr(event, "scene", None), "group_id", None)
+            scope = (True, str(gid) if gid else None)
+
+        event._comfy_scope = scope
+        return scope
 
     def _get_self_id(self, event: AstrMessageEvent):
-        getters = [
-            lambda e: e.get_self_id() if hasattr(e, "get_self_id") else None,
-            lambda e: getattr(e, "self_id", None),
-            lambda e: getattr(getattr(self.context, "bot", None), "self_id", None),
-            lambda e: getattr(self.context, "self_id", None),
-        ]
-        for g in getters:
+        get_self_id = getattr(event, "get_self_id", None)
+        if get_self_id is not None:
             try:
-                sid = g(event)
-                if sid:
-                    return str(sid)
+                sid = get_self_id()
             except Exception:
-                continue
-        return None
+                sid = None
+            if sid:
+                return str(sid)
+        sid = getattr(event, "self_id", None)
+        if sid:
+            return str(sid)
+        sid = getattr(getattr(self.context, "bot", None), "self_id", None)
+        if sid:
+            return str(sid)
+        sid = getattr(self.context, "self_id", None)
+        return str(sid) if sid else None
 
     def _is_ascii_term(self, s: str) -> bool:
-        return all(ord(ch) < 128 for ch in s)
-
-    def _build_policy_patterns(self):
+        return s.isascii()
+
+    def _iter_lexicon_terms(self):
+        """逐个产出词库中的 (分类, 词条)；有 ijson 时流式解析，不在内存中构建完整的词库 dict"""
+        with open(self.sensitive_words_path, "rb") as f:
+            if HAS_IJSON:
+                for prefix, event, value in ijson.parse(f):
+                    # 顶层 "分类": [词条, ...] 中的每个字符串，prefix 形如 "sexual.item"
+                    if event == "string" and prefix.endswith(".item") and prefix.count(".") == 1:
+                        yield prefix[:-5], value
+                return
+            data = json_loads(f.read())
+        for cat, terms in data.items():
+            if isinstance(terms, list):
+                for t in terms:
+                    if isinstance(t, str):
+                        yield cat, t
+
+    def _load_policy_terms(self) -> dict:
+        """读取词库，返回 {策略: (单词列表, 短语列表)}，只保留 ASCII 词条"""
+        # 分类 -> 引用该分类的策略
+        cat_policies = {}
         for policy, cats in self.policies.items():
-            word_terms = []
-            phrase_terms = []
             for cat in cats:
-                for t in self.lexicon.get(cat, []):
-                    if not t:
+                cat_policies.setdefault(cat, []).append(policy)
+
+        # 用 dict 保序去重，下标 0 为单词、1 为短语
+        buckets = {policy: ({}, {}) for policy in self.policies}
+        try:
+            if self.sensitive_words_path.exists():
+                word_count = 0
+                for cat, t in self._iter_lexicon_terms():
+                    word_count += 1
+                    if not t or not self._is_ascii_term(t):
                         continue
-                    if self._is_ascii_term(t):
-                        if " " in t: 
-                            phrase_terms.append(re.escape(t))
-                        else:         
-                            word_terms.append(re.escape(t))
-            word_terms = list(dict.fromkeys(word_terms))
-            phrase_terms = list(dict.fromkeys(phrase_terms))
+                    for policy in cat_policies.get(cat, ()):
+                        buckets[policy][" " in t][t] = None
+                logger.info(f"[ComfyUI] 🔒 敏感词库已加载: {word_count} 个词条")
+        except Exception as e:
+            logger.error(f"[ComfyUI] 读取敏感词库失败，敏感词过滤不生效: {e}")
+            buckets = {policy: ({}, {}) for policy in self.policies}
 
+        return {policy: (list(words), list(phrases)) for policy, (words, phrases) in buckets.items()}
+
+    def _build_policy_patterns(self):
+        """读取各策略的词条并清空已编译的匹配器，匹配器由 _compile_policy 按需构建"""
+        self._policy_terms = self._load_policy_terms()
+        self._policy_automata.clear()
+        self._policy_patterns.clear()
+
+    def _compile_policy(self, policy: str):
+        """编译并缓存策略的匹配器：优先使用 Aho-Corasick 自动机，不可用时回退到正则"""
+        word_terms, phrase_terms = self._policy_terms.get(policy, ([], []))
+        compiled = self._policy_automata if HAS_AHOCORASICK else self._policy_patterns
+        if len(word_terms) + len(phrase_terms) == 1:
+            # 只有一个词条时不必构建自动机或正则，直接子串查找：("literal", 原词条, 小写词条, 是否短语)
+            term = (word_terms or phrase_terms)[0]
+            matcher = ("literal", term, term.lower(), bool(phrase_terms))
+        elif HAS_AHOCORASICK:
+            matcher = self._build_automaton(word_terms, phrase_terms)
+        else:
+            matcher = self._compile_ascii_patterns(word_terms, phrase_terms)
+        # 热路径中只做匹配，正则列表里不允许出现未编译的字符串
+        if isinstance(matcher, list) and any(isinstance(pat, str) for pat in matcher):
+            raise TypeError(f"[ComfyUI] 敏感词策略 {policy} 的正则未编译")
+        # 编译过程中没有 await，同一策略不会被并发编译；setdefault 保证只保留一份
+        return compiled.setdefault(policy, matcher)
+
+    def _compile_ascii_patterns(self, word_terms: list, phrase_terms: list):
+        """编译回退用的正则列表，无词条时返回 None"""
+        if not word_terms and not phrase_terms:
+            return None
+        # 长词优先，减少分支回溯；短语通常更长，放在单词之前
+        word_terms = sorted(word_terms, key=len, reverse=True)
+        phrase_terms = sorted(phrase_terms, key=len, reverse=True)
+
+        if HAS_RE2:
+            # RE2 自带前缀过滤且不回溯，保持单个正则即可
+            # RE2 不支持环视，但其 \b 只按 ASCII 判断，效果等同下方的环视
             parts = []
-            if word_terms:
-                parts.append(r'(?<![A-Za-z0-9_])(?:' + '|'.join(word_terms) + r')(?![A-Za-z0-9_])')
             if phrase_terms:
-                parts.append('|'.join(phrase_terms))
-
-            ascii_pat = re.compile('|'.join(parts), re.IGNORECASE) if parts else None
-            self._policy_patterns[policy] = ascii_pat
+                parts.append('|'.join(map(re.escape, phrase_terms)))
+            if word_terms:
+                parts.append(r'\b(?:' + '|'.join(map(re.escape, word_terms)) + r')\b')
+            return [re2.compile('(?i)' + '|'.join(parts))]
+
+        # 标准库 re：按首字符分组，每组一个正则且以该字符开头，
+        # _sre 据此用前缀字符集快速跳过不可能命中的位置（整体交替或开头的环视会让这一优化失效）
+        by_first = {}
+        single_chars = []
+        for t in phrase_terms:
+            by_first.setdefault(t[0].lower(), ([], []))[1].append(t)
+        for t in word_terms:
+            if len(t) == 1:
+                single_chars.append(t)
+            else:
+                by_first.setdefault(t[0].lower(), ([], []))[0].append(t)
+
+        # 左边界放在首字符之后，用定宽后顾检查首字符前一位；
+        # 不用 \b：Unicode 模式下中文也算单词字符，"中文nude" 会漏判
+        patterns = []
+        for first, (words, phrases) in by_first.items():
+            alts = []
+            if phrases:
+                alts.append(_alternation([t[1:] for t in phrases]))
+            if words:
+                alts.append(r'(?<![A-Za-z0-9_].)(?:' + _alternation([t[1:] for t in words]) + r')(?![A-Za-z0-9_])')
+            patterns.append(re.compile(re.escape(first) + '(?:' + '|'.join(alts) + ')', re.IGNORECASE))
+        if single_chars:
+            # 单字符词条合并为一个字符类
+            patterns.append(re.compile(_char_class(single_chars) + r'(?<![A-Za-z0-9_].)(?![A-Za-z0-9_])', re.IGNORECASE))
+        return patterns
+
+    def _build_automaton(self, word_terms: list, phrase_terms: list):
+        """构建 Aho-Corasick 自动机，键为小写词条，值为 (原词条, 是否短语)"""
+        if not word_terms and not phrase_terms:
+            return None
+        ac = ahocorasick.Automaton()
+        for t in word_terms:
+            ac.add_word(t.lower(), (t, False))
+        for t in phrase_terms:
+            ac.add_word(t.lower(), (t, True))
+        ac.make_automaton()
+        return ac
+
+    def _policy_matcher(self, policy: str):
+        """返回策略对应的匹配器（自动机、正则列表或单词条字面量），首次使用时编译；无词条或未知策略为 None"""
+        compiled = self._policy_automata if HAS_AHOCORASICK else self._policy_patterns
+        if policy in compiled:
+            return compiled[policy]
+        return self._compile_policy(policy)
 
     def _get_policy_for_event(self, event: AstrMessageEvent) -> str:
-        if self._is_group_message(event):
-            gid = self._get_group_id(event)
+        cached = getattr(event, "_comfy_policy", None)
+        if cached:
+            return cached
+        is_group, gid = self._resolve_scope(event)
+        if is_group:
             if not gid:
-                return self.default_group_policy
-            return self.group_policies.get(gid, self.default_group_policy)
-        return self.default_private_policy
-
-    def _find_sensitive_words(self, text: str, event: AstrMessageEvent = None):
-        if not text:
+                policy = self.default_group_policy
+            else:
+                policy = self.group_policies.get(gid, self.default_group_policy)
+        else:
+            policy = self.default_private_policy
+        event._comfy_policy = policy
+        return policy
+
+    def _find_sensitive_words(self, text: str, event: AstrMessageEvent = None, first_only: bool = False):
+        """查找文本中的敏感词；first_only 为 True 时命中第一个即返回"""
+        # 词库只收录英文词条，不含任何英文字母/数字的文本（如纯中文提示词）不可能命中
+        if not text or not _HAS_WORD_CHAR(text):
             return []
-        policy = "full"
-        if event is not None:
-            policy = self._get_policy_for_event(event)
+        policy = "full" if event is None else self._get_policy_for_event(event)
+        matcher = self._policy_matcher(policy)
 
-        if policy == "none":
+        if matcher is None:
             return []
 
-        ascii_pat = self._policy_patterns.get(str(policy).lower())
-        if not ascii_pat:
+        if type(matcher) is tuple:
+            return self._scan_literal(text, *matcher[1:])
+
+        if HAS_AHOCORASICK:
+            return self._scan_automaton(matcher, text, first_only)
+
+        if first_only:
+            for pat in matcher:
+                m = pat.search(text)
+                if m:
+                    return [m.group(0)]
             return []
 
+        # 多个正则各自扫描，按命中位置排序以保持原文顺序
+        hits = sorted(
+            (m.start(), m.group(0)) for pat in matcher for m in pat.finditer(text)
+        )
         seen = set()
         result = []
-        for m in ascii_pat.finditer(text):
-            w = m.group(0)
+        for _, w in hits:
             key = w.lower()
             if key not in seen:
                 seen.add(key)
                 result.append(w)
         return result
 
+    def _scan_literal(self, text: str, term: str, key: str, is_phrase: bool) -> list:
+        """单词条策略：str.find 查找小写词条，单词类词条校验英文单词边界"""
+        text_lower = text if text.islower() else text.lower()
+        n = len(text_lower)
+        idx = text_lower.find(key)
+        while idx >= 0:
+            end = idx + len(key)
+            if is_phrase or (
+                (idx == 0 or text_lower[idx - 1] not in _WORD_CHARS)
+                and (end >= n or text_lower[end] not in _WORD_CHARS)
+            ):
+                return [term]
+            idx = text_lower.find(key, idx + 1)
+        return []
+
+    def _scan_automaton(self, ac, text: str, first_only: bool = False) -> list:
+        """单次线性扫描文本，单词类词条额外校验英文单词边界"""
+        # 绘图提示词多为全小写，此时无需再复制一份
+        text_lower = text if text.islower() else text.lower()
+        n = len(text_lower)
+        seen = set()
+        result = []
+        for end, (term, is_phrase) in ac.iter(text_lower):
+            if not is_phrase:
+                start = end - len(term) + 1
+                if start > 0 and text_lower[start - 1] in _WORD_CHARS:
+                    continue
+                if end + 1 < n and text_lower[end + 1] in _WORD_CHARS:
+                    continue
+            if first_only:
+                return [term]
+            # 自动机的键已是小写且唯一，同一键只对应一个原词条，直接按原词条去重
+            if term not in seen:
+                seen.add(term)
+                result.append(term)
+        return result
+
+    async def _send_chain_groups(self, event: AstrMessageEvent, groups: list) -> bool:
+        """把各段合并成一条消息发送；整条被拒（如超出平台大小限制）时退回逐段发送。返回是否有内容送达"""
+        chain = [comp for group in groups for comp in group]
+        if not chain:
+            return False
+        try:
+            await event.send(event.chain_result(chain))
+            logger.info(f"[ComfyUI] 📤 多图消息已发送，共 {len(groups)} 段")
+            return True
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 合并发送多图消息失败，改为逐段发送: {e}")
+
+        delivered = 0
+        for i, group in enumerate(groups, 1):
+            try:
+                await event.send(event.chain_result(group))
+                delivered += 1
+            except Exception as e:
+                logger.error(f"[ComfyUI] 第 {i} 段发送失败: {e}")
+        logger.info(f"[ComfyUI] 📤 逐段发送完成: {delivered}/{len(groups)}")
+        return delivered > 0
+
+    async def _generate_limited(self, prompt: str, img_idx: int, total: int):
+        """在 max_parallel 并发上限内调用 ComfyUI 生成一张图片"""
+        async with self._generate_semaphore:
+            logger.info(f"[ComfyUI] 🎨 [{img_idx}/{total}] 开始生成: {prompt[:50]}...")
+            return await self.api.generate(prompt)
+
+    async def _make_image_component(self, img_data: bytes):
+        """构建图片消息组件，返回 (组件, 文件名)；未开启保存时直接使用内存数据，文件名为 None"""
+        if not self.persist_images:
+            return Image.fromBytes(img_data), None
+
+        img_filename = f"{os.urandom(8).hex()}.png"
+        img_path = self.output_dir / img_filename
+        # 写盘放到事件循环之外，避免大图阻塞其他请求
+        if HAS_AIOFILES:
+            async with aiofiles.open(img_path, 'wb') as fp:
+                await fp.write(img_data)
+        else:
+            await asyncio.to_thread(img_path.write_bytes, img_data)
+        return Image.fromFileSystem(str(img_path)), img_filename
+
     # ====== 修改提取逻辑 ======
     @filter.on_llm_response(priority=1)
     async def _extract_prompt_before_filter(self, event: AstrMessageEvent, resp: LLMResponse):
@@ -1073,200 +1451,169 @@ class ComfyUIPlugin(Star):
     
         full_text = resp.completion_text
     
-        # 提取所有 <提示词>xxx</提示词>
-        prompts = re.findall(r'<提示词>(.*?)</提示词>', full_text, flags=re.DOTALL)
-    
-        if not prompts:
-            return
-    
-        # 清理提示词内容
-        cleaned_prompts = []
-        for p in prompts:
-            # 去除可能残留的 "提示词是:" 前缀
-            p = re.sub(r'^提示词是\s*[:：]?\s*', '', p).strip()
+        # 单次扫描：每个 <提示词>xxx</提示词> 与它前面的文字配成一对，多图模式按顺序发送
+        pairs = []
+        pending = []  # 尚未配对的文字（内容为空的提示词不成对，其前后文字合并到下一对）
+        last = 0
+        for m in _PROMPT_RE.finditer(full_text):
+            text = full_text[last:m.start()].strip()
+            if text:
+                pending.append(text)
+            last = m.end()
+
+            # 去除可能残留的 "提示词是:" 前缀（绝大多数提示词没有，先用 startswith 判断）
+            p = m.group(1)
+            if p.startswith(_PROMPT_PREFIX):
+                p = p[len(_PROMPT_PREFIX):].lstrip()
+                if p[:1] in (":", "："):
+                    p = p[1:]
+            p = p.strip()
             # 去除多余符号
-            p = p.strip('`"\'""''').strip()
+            p = p.strip(_STRIP_CHARS).strip()
             if p:
-                cleaned_prompts.append(p)
+                pairs.append({"text": "\n".join(pending), "prompt": p})
+                pending = []
     
-        if not cleaned_prompts:
+        if not pairs:
             return
     
         # 如果只有一个提示词 → 单图模式
-        if len(cleaned_prompts) == 1:
-            event._comfy_extracted_prompt = cleaned_prompts[0]
-            logger.info(f"[ComfyUI] 📝 检测到单图模式: {cleaned_prompts[0][:50]}...")
+        if len(pairs) == 1:
+            event._comfy_state = {"prompt": pairs[0]["prompt"]}
+            logger.info(f"[ComfyUI] 📝 检测到单图模式: {pairs[0]['prompt'][:50]}...")
             return
     
         # 多个提示词 → 多图模式（仅在开启时生效）
         if self.multi_image_mode:
-            # 使用正则分割，保留文本和提示词
-            parts = re.split(r'<提示词>.*?</提示词>', full_text, flags=re.DOTALL)
-        
-            # 构建段落列表
-            segments = []
-            prompt_idx = 0
-        
-            for i, text in enumerate(parts):
-                # 添加文本段落
-                text = text.strip()
-                if text:
-                    segments.append({"type": "text", "content": text})
-            
-                # 添加对应的提示词（除了最后一个文本段）
-                if prompt_idx < len(cleaned_prompts):
-                    segments.append({"type": "prompt", "content": cleaned_prompts[prompt_idx]})
-                    prompt_idx += 1
-        
-            if segments:
-                event._comfy_segments = segments
-                logger.info(f"[ComfyUI] 📝 检测到多图模式，共 {len(cleaned_prompts)} 张图片")
+            prompt_count = len(pairs)
+            # 最后剩余的文字（没有对应提示词）单独成对
+            text = full_text[last:].strip()
+            if text:
+                pending.append(text)
+            if pending:
+                pairs.append({"text": "\n".join(pending), "prompt": None})
+            event._comfy_state = {"pairs": pairs}
+            logger.info(f"[ComfyUI] 📝 检测到多图模式，共 {prompt_count} 张图片")
         else:
             # 多图模式未开启，只取第一个提示词
-            event._comfy_extracted_prompt = cleaned_prompts[0]
-            logger.warning(f"[ComfyUI] 检测到 {len(cleaned_prompts)} 个提示词，但多图模式未开启，仅使用第一个")
+            event._comfy_state = {"prompt": pairs[0]["prompt"]}
+            logger.warning(f"[ComfyUI] 检测到 {len(pairs)} 个提示词，但多图模式未开启，仅使用第一个")
 
     # ====== 自动绘图逻辑保持不变 ======
     @filter.on_decorating_result(priority=99)
     async def _auto_paint_from_llm(self, event: AstrMessageEvent):
         """自动绘图（支持单图和多图分段模式）"""
-        if getattr(event, "_comfy_auto_painted", False):
+        # 提取阶段写入的状态：{"prompt": 单图提示词} 或 {"pairs": 多图 (文字, 提示词) 列表}，处理后标记 painted
+        state = getattr(event, "_comfy_state", None)
+        if not state or state.get("painted"):
             return
 
         # 检查是否有多图段落
-        segments = getattr(event, "_comfy_segments", None)
+        pairs = state.get("pairs")
 
         # === 多图分段模式 ===
-        if segments and self.multi_image_mode:
-            event._comfy_auto_painted = True
+        if pairs and self.multi_image_mode:
+            state["painted"] = True
     
             # 检查权限
-            allowed, reason = self._check_access(event)
+            user_id = str(event.get_sender_id())
+            is_admin = user_id in self.admin_user_ids
+            allowed, reason = self._check_access(event, user_id, is_admin)
             if not allowed:
                 logger.warning(f"[ComfyUI] 多图请求被拒绝: {reason}")
                 return
     
             # 计算图片数量
-            prompt_count = sum(1 for s in segments if s["type"] == "prompt")
+            prompt_count = sum(1 for pair in pairs if pair["prompt"])
             logger.info(f"[ComfyUI] 🎨 开始多图分段生成，共 {prompt_count} 张图片")
     
-            # 重组段落：将 (文字, 提示词) 配对
-            pairs = []
-            current_text = ""
-        
-            for segment in segments:
-                if segment["type"] == "text":
-                    current_text = segment["content"]
-                elif segment["type"] == "prompt":
-                    pairs.append({
-                        "text": current_text,
-                        "prompt": segment["content"]
-                    })
-                    current_text = ""  # 重置
-        
-            # 如果最后还有剩余文字（没有对应提示词），单独处理
-            if current_text:
-                pairs.append({"text": current_text, "prompt": None})
-        
             # 冷却检查（只检查一次）
-            ok, remain = self._check_cooldown(event)
+            ok, remain = self._check_cooldown(event, user_id, is_admin)
             if not ok:
                 try:
                     await event.send(event.plain_result(f"⏱️ 冷却中，请 {remain} 秒后重试"))
                 except:
                     pass
-                logger.warning(f"[ComfyUI] 用户 {event.get_sender_id()} 冷却中")
+                logger.warning(f"[ComfyUI] 用户 {user_id} 冷却中")
                 return
         
-            # 依次处理每对 (文字 + 图片)
+            # 先逐张做敏感词检查，再并发生成所有通过检查的图片
+            tasks = []
             img_idx = 0
+            for pair in pairs:
+                if pair["prompt"]:
+                    img_idx += 1
+                    pair["idx"] = img_idx
+                    pair["passed"], pair["sensitive"] = self._check_sensitive(pair["prompt"], event, user_id, is_admin)
+                    if pair["passed"]:
+                        tasks.append(self._generate_limited(pair["prompt"], img_idx, prompt_count))
+            results = iter(await asyncio.gather(*tasks, return_exceptions=True))
+        
+            # 按原顺序为每对 (文字 + 图片) 生成一段消息，合并成一条发送
+            groups = []
             for pair in pairs:
                 text_content = pair["text"]
                 prompt_content = pair["prompt"]
             
-                # 如果有提示词，生成图片
+                # 如果有提示词，加入生成的图片
                 if prompt_content:
-                    img_idx += 1
+                    img_idx = pair["idx"]
                 
-                    # 敏感词检查
-                    passed, sensitive = self._check_sensitive(prompt_content, event)
-                    if not passed:
-                        tip = "、".join(sensitive[:3])
-                        try:
-                            await event.send(event.plain_result(f"{text_content}\n🚫 [图片{img_idx}] 检测到敏感词：{tip}"))
-                        except:
-                            pass
+                    # 敏感词检查未通过
+                    if not pair["passed"]:
+                        tip = "、".join(pair["sensitive"][:3])
+                        groups.append([Plain(f"{text_content}\n🚫 [图片{img_idx}] 检测到敏感词：{tip}\n")])
                         logger.warning(f"[ComfyUI] 图片 {img_idx} 触发敏感词，已跳过")
                         continue
                 
-                    # 生成图片
                     try:
-                        logger.info(f"[ComfyUI] 🎨 [{img_idx}/{prompt_count}] 开始生成: {prompt_content[:50]}...")
-                        img_data, error_msg = await self.api.generate(prompt_content)
+                        outcome = next(results)
+                        if isinstance(outcome, BaseException):
+                            raise outcome
+                        img_data, error_msg = outcome
                     
                         if not img_data:
                             logger.error(f"[ComfyUI] 图片 {img_idx} 生成失败: {error_msg}")
-                            try:
-                                await event.send(event.plain_result(f"{text_content}\n❌ [图片{img_idx}] 生成失败"))
-                            except:
-                                pass
+                            groups.append([Plain(f"{text_content}\n❌ [图片{img_idx}] 生成失败\n")])
                             continue
                     
-                        # 保存图片
-                        img_filename = f"{uuid.uuid4()}.png"
-                        img_path = self.output_dir / img_filename
-                        with open(img_path, 'wb') as fp:
-                            fp.write(img_data)
+                        image_component, img_filename = await self._make_image_component(img_data)
                     
-                        # 发送：文字 + 图片 一起
-                        chain = []
-                        if text_content:
-                            chain.append(Plain(text_content + "\n"))
-                        chain.append(Image.fromFileSystem(str(img_path)))
-                    
-                        await event.send(event.chain_result(chain))
-                        logger.info(f"[ComfyUI] ✅ [{img_idx}/{prompt_count}] 文字+图片已发送: {img_filename}")
+                        # 文字 + 图片 放在一起
+                        group = [Plain(text_content + "\n")] if text_content else []
+                        group.append(image_component)
+                        groups.append(group)
+                        logger.info(f"[ComfyUI] ✅ [{img_idx}/{prompt_count}] 图片已生成: {img_filename or '未保存'}")
                     
                     except Exception as e:
                         logger.error(f"[ComfyUI] 图片 {img_idx} 处理异常: {e}")
                         logger.error(traceback.format_exc())
             
-                else:
+                elif text_content:
                     # 只有文字，没有提示词
-                    if text_content:
-                        try:
-                            await event.send(event.plain_result(text_content))
-                            logger.info(f"[ComfyUI] 📤 纯文字已发送")
-                        except Exception as e:
-                            logger.error(f"[ComfyUI] 发送文字失败: {e}")
-    
-            # 处理完毕，清空原结果
-            result = event.get_result()
-            if result:
-                result.chain.clear()
+                    groups.append([Plain(text_content)])
+        
+            # 处理完毕，有内容送达时才清空原结果；全部发送失败则保留 LLM 的原始回复
+            if await self._send_chain_groups(event, groups):
+                result = event.get_result()
+                if result:
+                    result.chain.clear()
     
             return
 
         # === 单图模式（原有逻辑）===
-        prompt = getattr(event, "_comfy_extracted_prompt", None)
+        prompt = state.get("prompt")
         if not prompt:
             return
 
-        event._comfy_auto_painted = True
-
-        def _has_image(comp):
-            if isinstance(comp, Image):
-                return True
-            if isinstance(comp, Node):
-                return any(_has_image(c) for c in comp.content)
-            return False
+        state["painted"] = True
 
         result = event.get_result()
         if not result:
             return
     
         chain = result.chain
-        if chain and any(_has_image(c) for c in chain):
+        if chain and _chain_has_image(chain):
             return
 
         extra_chain = []
@@ -1293,7 +1640,9 @@ class ComfyUIPlugin(Star):
         """
 
         # 权限检查
-        allowed, reason = self._check_access(event)
+        user_id = str(event.get_sender_id())
+        is_admin = user_id in self.admin_user_ids
+        allowed, reason = self._check_access(event, user_id, is_admin)
         if not allowed:
             return event.plain_result(reason)
 
@@ -1301,55 +1650,52 @@ class ComfyUIPlugin(Star):
         if not prompt and text:
             prompt = text
 
+        return await self._txt2img(event, prompt, user_id, is_admin)
+
+    async def _txt2img(self, event: AstrMessageEvent, prompt: str, user_id: str, is_admin: bool):
+        """
+        文生图主流程（不含权限检查），供 LLM 工具和 /draw 共用
+        调用方需已完成权限检查，并传入算好的 user_id / is_admin
+        """
         if not prompt:
             return event.plain_result("❌ 未提供 prompt，请重试")
 
         if not isinstance(prompt, str) or not prompt.strip():
             raw = getattr(event, "message_str", "") or ""
-            prompt = re.sub(r'```math\s*At:\d+```\s*', '', raw).strip()
+            prompt = _MATH_AT_RE.sub('', raw).strip()
             if not prompt:
                 return event.plain_result("❌ 请输入提示词")
 
         # API 检查
-        if not getattr(self, 'api', None):
+        api = self.api
+        if not api:
             return event.plain_result("❌ ComfyUI 服务未连接，请检查配置")
 
         try:
-            # 敏感词检查
-            passed, sensitive = self._check_sensitive(prompt, event)
-            if not passed:
-                tip = "、".join(sensitive[:5])
-                logger.warning(f"[ComfyUI] 用户 {event.get_sender_id()} 触发敏感词: {tip}")
-                return event.plain_result(f"🚫 检测到敏感词：{tip}，无法生成")
-
-            # 冷却检查
-            ok, remain = self._check_cooldown(event)
+            # 敏感词、冷却检查
+            ok, reason = self._gate(event, prompt, user_id, is_admin)
             if not ok:
-                return event.plain_result(f"⏱️ 冷却中，请在 {remain} 秒后重试")
+                return event.plain_result(reason)
 
-            logger.info(f"[ComfyUI] 🎨 开始生成 | 用户: {event.get_sender_id()} | Prompt: {prompt[:50]}...")
+            logger.info(f"[ComfyUI] 🎨 开始生成 | 用户: {user_id} | Prompt: {prompt[:50]}...")
 
             # 调用 API
-            img_data, error_msg = await self.api.generate(prompt)
+            img_data, error_msg = await api.generate(prompt)
 
             if not img_data:
                 logger.error(f"[ComfyUI] 生成失败: {error_msg}")
                 return event.plain_result(f"❌ 生成失败：{error_msg}")
 
-            # 保存图片
-            img_filename = f"{uuid.uuid4()}.png"
-            img_path = self.output_dir / img_filename
-            with open(img_path, 'wb') as fp:
-                fp.write(img_data)
-
-            logger.info(f"[ComfyUI] ✅ 图片已保存: {img_filename}")
+            image_component, img_filename = await self._make_image_component(img_data)
+            if img_filename:
+                logger.info(f"[ComfyUI] ✅ 图片已保存: {img_filename}")
 
             # 发送图片给用户
             import astrbot.api.message_components as Comp
             from astrbot.api.event import MessageChain
             chain = MessageChain(chain=[
                 Comp.Plain("已生成图片！"),
-                Comp.Image.fromFileSystem(str(img_path))
+                image_component
             ])
             await event.send(chain)
 